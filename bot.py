@@ -13,6 +13,9 @@ from telegram.ext import Application, CommandHandler, MessageHandler, filters, C
 from telegram.error import TelegramError
 from dotenv import load_dotenv
 from supabase import create_client, Client
+from exporter import SupabaseExporter, EXPORT_TABLES, EXPORT_FORMATS, parse_export_date
+from rollups import RevenueRollups
+from reconcile import MembershipReconciler
 
 # PIEVIENOJIET ŠO KODA SĀKUMĀ - pirms citiem importiem
 os.environ['PYTHONIOENCODING'] = 'utf-8'
@@ -43,6 +46,8 @@ SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 # Pārējā konfigurācija paliek nemainīga
 SUBSCRIPTION_PRICE = 25  # USDT
 SUBSCRIPTION_DAYS = 30
+TELEGRAM_DOCUMENT_LIMIT = 50 * 1024 * 1024  # Bot API maksimālais dokumenta izmērs
+RECONCILE_INTERVAL_HOURS = 24
 
 # Logging konfigurācija ar UTF-8 atbalstu
 logging.basicConfig(
@@ -72,6 +77,8 @@ class CryptoArenaBot:
       self.supabase_url = os.getenv("SUPABASE_URL")
       self.supabase_key = os.getenv("SUPABASE_KEY")
       self.bot_username = None # Tiks iestatīts run() funkcijā
+      self.export_lock = asyncio.Lock() # Vienlaikus tiek veikts tikai viens eksports
+      self.reconcile_lock = asyncio.Lock() # Vienlaikus tiek veikta tikai viena dalības pārbaude
 
       if not all([self.telegram_bot_token, self.admin_user_id is not None, self.group_id is not None, self.tronscan_api_key, self.wallet_address, self.supabase_url, self.supabase_key]):
           logger.error("Trūkst viens vai vairāki nepieciešamie vides mainīgie. Lūdzu, pārbaudiet .env failu vai servera konfigurāciju.")
@@ -95,6 +102,9 @@ class CryptoArenaBot:
           logger.error(f"❌ Supabase savienojuma kļūda: {error_message_safe}")
           raise
           
+      self.exporter = SupabaseExporter(self.supabase)
+      self.rollups = RevenueRollups(self.supabase)
+      self.reconciler = MembershipReconciler(self.app.bot, self.supabase, self.group_id, SUBSCRIPTION_DAYS, self.rollups)
       self.setup_handlers()
 
   def setup_handlers(self):
@@ -102,6 +112,9 @@ class CryptoArenaBot:
       self.app.add_handler(CommandHandler("start", self.start_command))
       self.app.add_handler(CommandHandler("status", self.status_command))
       self.app.add_handler(CommandHandler("admin", self.admin_command))
+      self.app.add_handler(CommandHandler("export", self.export_command))
+      self.app.add_handler(CommandHandler("revenue", self.revenue_command))
+      self.app.add_handler(CommandHandler("reconcile", self.reconcile_command))
       self.app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_txid))
       self.app.add_handler(CommandHandler("sendtx", self.sendtx_command))
       # handle_payment_choice vairs netiek izmantots tieši ar callback_data, jo USDT poga tagad izmanto deep link
@@ -374,18 +387,20 @@ Nosūti man TXID pēc maksājuma veikšanas. (Sagaidi kamēr visi bloki ir apsti
       logger.debug(f"Entered save_transaction function for TXID: {txid}, User ID: {user_id}, Amount: {amount}")
       logger.debug(f"💾 save_transaction() called with user_id={user_id!r}, txid={txid!r}") # Changed to logger.debug
       
+      verified_at = datetime.now(timezone.utc) # Labojums: izmanto timezone.utc
       try:
           resp = self.supabase.table("transactions").insert({
               "txid": txid,
               "user_id": str(user_id), # Pārliecināmies, ka user_id tiek saglabāts kā string
               "amount": amount,
-              "verified_at": datetime.now(timezone.utc).isoformat() # Labojums: izmanto timezone.utc
+              "verified_at": verified_at.isoformat()
           }).execute()
 
           logger.debug(f"🟢 Supabase raw response: {resp!r}") # Changed to logger.debug
           
           if hasattr(resp, "data") and resp.data:
               logger.debug(f"✅ resp.data: {resp.data}") # Changed to logger.debug
+              self.update_revenue_rollup(txid, user_id, verified_at, amount)
               return True
           else:
               logger.error(f"❌ No resp.data attribute, resp attrs: {dir(resp)}") # Changed to logger.error
@@ -398,6 +413,15 @@ Nosūti man TXID pēc maksājuma veikšanas. (Sagaidi kamēr visi bloki ir apsti
           logger.exception(f"🔺 Exception when inserting into Supabase: {error_message_safe}") # Changed to logger.exception
           return False
 
+  def update_revenue_rollup(self, txid: str, user_id: int, verified_at: datetime, amount: float):
+      """Atjauno dienas ieņēmumu kopsummu (kļūda neietekmē maksājuma apstrādi)"""
+      try:
+          is_renewal = self.rollups.is_renewal(user_id, txid)
+          self.rollups.record_transaction(verified_at, amount, is_renewal)
+      except Exception as e:
+          error_message_safe = str(e).encode('ascii', 'replace').decode('ascii')
+          logger.error(f"Error updating revenue rollup for {user_id}: {error_message_safe}")
+
   async def save_subscription(self, user, txid: str):
       """Saglabā abonementu Supabase datubāzē"""
       logger.debug(f"Entered save_subscription function for user: {user.id}, TXID: {txid}")
@@ -498,16 +522,19 @@ Nosūti man TXID pēc maksājuma veikšanas. (Sagaidi kamēr visi bloki ir apsti
           total_count = total_count_resp.count if total_count_resp.count is not None else 0
           logger.debug(f"Total users count: {total_count}")
           
-          today = datetime.now(timezone.utc).date() # Labojums: izmanto timezone.utc
-          today_revenue_resp = self.supabase.table("transactions").select("amount").gte("verified_at", today.isoformat()).lt("verified_at", (today + timedelta(days=1)).isoformat()).execute()
-          today_revenue = sum(item['amount'] for item in today_revenue_resp.data) if today_revenue_resp.data else 0
-          logger.debug(f"Today's revenue: {today_revenue}")
-          
       except Exception as e:
           error_message_safe = str(e).encode('ascii', 'replace').decode('ascii')
           logger.error(f"Error fetching admin data from Supabase: {error_message_safe}")
           active_count = 0
           total_count = 0
+
+      try:
+          today = datetime.now(timezone.utc).date() # Labojums: izmanto timezone.utc
+          today_revenue = self.rollups.report(today, today)["revenue"]
+          logger.debug(f"Today's revenue: {today_revenue}")
+      except Exception as e:
+          error_message_safe = str(e).encode('ascii', 'replace').decode('ascii')
+          logger.error(f"Error fetching today's revenue rollup: {error_message_safe}")
           today_revenue = 0
       
       admin_text = f"""
@@ -521,11 +548,189 @@ Komandas:
 /start - Sākuma ziņojums
 /status - Abonementa status
 /admin - Admin panelis
+/export - Datu eksports (subscriptions/transactions)
+/revenue - Ieņēmumi periodā
+/reconcile - Grupas dalības pārbaude
   """
       
       await update.message.reply_text(admin_text, parse_mode='Markdown')
       logger.debug("Admin panel message sent.")
 
+  async def export_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+      """Eksportē abonementus vai transakcijas kā saspiestu dokumentu"""
+      logger.debug(f"Entered export_command for user: {update.effective_user.id}")
+      if update.effective_user.id != self.admin_user_id:
+          await update.message.reply_text("❌ Nav atļaujas.")
+          logger.debug("Unauthorized export access attempt.")
+          return
+
+      usage = (
+          "Lietošana:\n`/export <subscriptions|transactions> [csv|ndjson] [from=YYYY-MM-DD] [to=YYYY-MM-DD] [active]`"
+      )
+      if not context.args or context.args[0] not in EXPORT_TABLES:
+          await update.message.reply_text(usage, parse_mode='Markdown')
+          return
+
+      table = context.args[0]
+      fmt = "csv"
+      date_from = None
+      date_to = None
+      active_only = False
+      try:
+          for arg in context.args[1:]:
+              if arg in EXPORT_FORMATS:
+                  fmt = arg
+              elif arg == "active":
+                  active_only = True
+              elif arg.startswith("from="):
+                  date_from = parse_export_date(arg[len("from="):])
+              elif arg.startswith("to="):
+                  date_to = parse_export_date(arg[len("to="):])
+              else:
+                  raise ValueError(f"Nezināms parametrs: {arg}")
+          # Pārbaudām filtrus pirms eksporta sākšanas
+          self.exporter.build_filters(table, date_from, date_to, active_only)
+      except ValueError as e:
+          await update.message.reply_text(f"❌ {e}")
+          await update.message.reply_text(usage, parse_mode='Markdown')
+          return
+
+      if self.export_lock.locked():
+          await update.message.reply_text("⏳ Eksports jau notiek. Lūdzu uzgaidi.")
+          return
+
+      await update.message.reply_text(f"📦 Sāku {table} eksportu ({fmt})...")
+      # Eksports notiek fonā, lai bots turpinātu apstrādāt citus ziņojumus
+      asyncio.create_task(self._run_export(update.effective_chat.id, table, fmt, date_from, date_to, active_only))
+
+  async def _run_export(self, chat_id: int, table: str, fmt: str, date_from, date_to, active_only: bool):
+      """Veic eksportu atsevišķā pavedienā un nosūta failu adminam"""
+      async with self.export_lock:
+          try:
+              path, count = await asyncio.to_thread(self.exporter.export_to_tempfile, table, fmt, date_from, date_to, active_only)
+          except Exception as e:
+              error_message_safe = str(e).encode('ascii', 'replace').decode('ascii')
+              logger.error(f"Error exporting {table}: {error_message_safe}")
+              await self.app.bot.send_message(chat_id=chat_id, text="❌ Eksports neizdevās. Skaties logus.")
+              return
+
+          size = os.path.getsize(path)
+          if size > TELEGRAM_DOCUMENT_LIMIT:
+              logger.warning(f"Export file {path} is {size} bytes, too large for Telegram")
+              await self.app.bot.send_message(
+                  chat_id=chat_id,
+                  text=f"⚠️ Fails ir par lielu nosūtīšanai ({size / 1024 / 1024:.1f} MB).\n"
+                       f"Tas saglabāts serverī: {path}"
+              )
+              return
+
+          try:
+              with open(path, "rb") as f:
+                  await self.app.bot.send_document(
+                      chat_id=chat_id,
+                      document=f,
+                      filename=os.path.basename(path),
+                      caption=f"✅ {table}: {count} rindas"
+                  )
+              logger.info(f"Export of {table} sent to admin: {count} rows, {size} bytes")
+          except Exception as e:
+              error_message_safe = str(e).encode('ascii', 'replace').decode('ascii')
+              logger.error(f"Error sending export document: {error_message_safe}")
+              await self.app.bot.send_message(chat_id=chat_id, text="❌ Neizdevās nosūtīt eksporta failu.")
+          finally:
+              os.remove(path)
+
+  async def revenue_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+      """Parāda ieņēmumus periodā no dienas kopsummām vai palaiž backfill"""
+      logger.debug(f"Entered revenue_command for user: {update.effective_user.id}")
+      if update.effective_user.id != self.admin_user_id:
+          await update.message.reply_text("❌ Nav atļaujas.")
+          logger.debug("Unauthorized revenue access attempt.")
+          return
+
+      if context.args and context.args[0] == "backfill":
+          await update.message.reply_text("🔄 Sāku ieņēmumu kopsummu pārrēķinu...")
+          asyncio.create_task(self._run_rollup_backfill(update.effective_chat.id))
+          return
+
+      today = datetime.now(timezone.utc).date()
+      try:
+          date_from = parse_export_date(context.args[0]) if context.args else today
+          date_to = parse_export_date(context.args[1]) if len(context.args or []) > 1 else date_from
+          if date_to < date_from:
+              raise ValueError("Beigu datums ir pirms sākuma datuma.")
+      except ValueError as e:
+          await update.message.reply_text(f"❌ {e}")
+          await update.message.reply_text(
+              "Lietošana:\n`/revenue [YYYY-MM-DD] [YYYY-MM-DD]`\n`/revenue backfill`",
+              parse_mode='Markdown'
+          )
+          return
+
+      try:
+          totals = await asyncio.to_thread(self.rollups.report, date_from, date_to)
+      except Exception as e:
+          error_message_safe = str(e).encode('ascii', 'replace').decode('ascii')
+          logger.error(f"Error fetching revenue report: {error_message_safe}")
+          await update.message.reply_text("❌ Neizdevās iegūt ieņēmumu atskaiti.")
+          return
+
+      revenue_text = f"""
+💰 **Ieņēmumi {date_from.strftime('%d.%m.%Y')} - {date_to.strftime('%d.%m.%Y')}:**
+
+💵 Summa: {totals['revenue']:.2f} USDT
+🧾 Transakcijas: {totals['transactions_count']}
+🆕 Jauni abonenti: {totals['new_subscribers']}
+🔁 Atjaunojumi: {totals['renewing_subscribers']}
+🚪 Beigušies abonementi: {totals['churned']}
+      """
+      await update.message.reply_text(revenue_text, parse_mode='Markdown')
+      logger.debug("Revenue report sent.")
+
+  async def _run_rollup_backfill(self, chat_id: int):
+      """Pārrēķina kopsummas atsevišķā pavedienā un paziņo rezultātu"""
+      try:
+          days = await asyncio.to_thread(self.rollups.backfill)
+          await self.app.bot.send_message(chat_id=chat_id, text=f"✅ Pārrēķinātas {days} dienas.")
+      except Exception as e:
+          error_message_safe = str(e).encode('ascii', 'replace').decode('ascii')
+          logger.error(f"Error in rollup backfill: {error_message_safe}")
+          await self.app.bot.send_message(chat_id=chat_id, text="❌ Kopsummu pārrēķins neizdevās. Skaties logus.")
+
+  async def reconcile_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+      """Palaiž grupas dalības salīdzināšanu ar abonementiem"""
+      logger.debug(f"Entered reconcile_command for user: {update.effective_user.id}")
+      if update.effective_user.id != self.admin_user_id:
+          await update.message.reply_text("❌ Nav atļaujas.")
+          logger.debug("Unauthorized reconcile access attempt.")
+          return
+
+      if self.reconcile_lock.locked():
+          await update.message.reply_text("⏳ Dalības pārbaude jau notiek. Lūdzu uzgaidi.")
+          return
+
+      if context.args and context.args[0] == "reset":
+          self.reconciler.clear_checkpoint()
+          await update.message.reply_text("🗑 Checkpoint dzēsts, nākamā pārbaude sāksies no sākuma.")
+          return
+
+      if self.reconciler.load_checkpoint():
+          await update.message.reply_text("🔁 Turpinu iepriekšējo dalības pārbaudi no checkpoint...")
+      else:
+          await update.message.reply_text("🔍 Sāku grupas dalības pārbaudi...")
+      asyncio.create_task(self.run_reconciliation())
+
+  async def run_reconciliation(self):
+      """Veic dalības salīdzināšanu un nosūta atskaiti adminam"""
+      async with self.reconcile_lock:
+          try:
+              state = await self.reconciler.run()
+              await self.notify_admin(self.reconciler.format_report(state))
+          except Exception as e:
+              error_message_safe = str(e).encode('ascii', 'replace').decode('ascii')
+              logger.error(f"Error in membership reconciliation: {error_message_safe}")
+              await self.notify_admin("❌ Dalības pārbaude pārtrūka. Nākamā palaišana turpinās no checkpoint.")
+
   async def notify_admin(self, message: str):
       """Nosūta ziņojumu adminam"""
       logger.debug(f"Notifying admin: {message}")
@@ -584,6 +789,7 @@ Komandas:
           logger.error(f"Error fetching expired users from Supabase: {error_message_safe}")
           expired_users = []
       
+      removed_count = 0
       for user_data in expired_users:
           user_id = user_data['user_id']
           username = user_data['username']
@@ -601,9 +807,12 @@ Komandas:
                   user_id=user_id
               )
               
-              update_resp = self.supabase.table("subscriptions").update({"is_active": False}).eq("user_id", user_id).execute()
+              update_resp = self.supabase.table("subscriptions").update({"is_active": False}).eq("user_id", user_id).eq("is_active", True).execute()
               if not update_resp.data:
-                  logger.error(f"Error deactivating subscription for {user_id}: No data returned. Error: {update_resp.error if hasattr(update_resp, 'error') else 'N/A'}")
+                  # Abonementu jau varēja deaktivizēt dalības pārbaude - churn netiek skaitīts atkārtoti
+                  logger.warning(f"Subscription for {user_id} was not deactivated (already inactive?). Error: {update_resp.error if hasattr(update_resp, 'error') else 'N/A'}")
+              else:
+                  removed_count += 1
               
               await self.app.bot.send_message(
                   chat_id=user_id,
@@ -617,6 +826,13 @@ Komandas:
               error_message_safe = str(e).encode('ascii', 'replace').decode('ascii')
               logger.error(f"Error removing expired user {user_id}: {error_message_safe}")
       
+      if removed_count:
+          try:
+              self.rollups.record_churn(now.date(), removed_count)
+          except Exception as e:
+              error_message_safe = str(e).encode('ascii', 'replace').decode('ascii')
+              logger.error(f"Error recording churn rollup: {error_message_safe}")
+
       if expired_users:
           await self.notify_admin(f"🔄 Noņemti {len(expired_users)} lietotāji ar beidzošiem abonementiem.")
 
@@ -633,6 +849,18 @@ Komandas:
               logger.error(f"Error in subscription checker: {error_message_safe}")
               await asyncio.sleep(300)  # Mēģina atkal pēc 5 minūtēm
 
+  async def reconciliation_checker(self):
+      """Periodiski salīdzina grupas dalību ar abonementiem"""
+      logger.debug("Starting reconciliation_checker loop.")
+      # Pēc restarta nepabeigtu pārbaudi turpinām uzreiz, nevis pēc diennakts
+      if self.reconciler.load_checkpoint() and not self.reconcile_lock.locked():
+          await self.notify_admin("🔁 Turpinu nepabeigto dalības pārbaudi no checkpoint...")
+          await self.run_reconciliation()
+      while True:
+          await asyncio.sleep(RECONCILE_INTERVAL_HOURS * 3600)
+          if not self.reconcile_lock.locked():
+              await self.run_reconciliation()
+
   async def run(self):
       """Palaiž botu"""
       # Iegūstam bota lietotājvārdu pirms handleri tiek izsaukti
@@ -642,6 +870,7 @@ Komandas:
 
       # Sāk abonementu pārbaudītāju
       asyncio.create_task(self.subscription_checker())
+      asyncio.create_task(self.reconciliation_checker())
       
       # Sāk botu
       await self.app.initialize()
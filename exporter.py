@@ -0,0 +1,159 @@
+import os
+import sys
+import csv
+import gzip
+import json
+import logging
+import argparse
+import tempfile
+
+from datetime import datetime, date, timedelta, timezone
+from typing import Optional, Dict, Any, Iterator, List, Tuple
+from dotenv import load_dotenv
+from supabase import create_client, Client
+
+logger = logging.getLogger(__name__)
+
+# Cik rindas tiek nolasītas vienā Supabase pieprasījumā
+EXPORT_PAGE_SIZE = 1000
+EXPORT_FORMATS = ("csv", "ndjson")
+
+# Katrai tabulai: unikālā atslēga keyset lapošanai, datuma kolonna filtram un eksportējamās kolonnas
+EXPORT_TABLES: Dict[str, Dict[str, Any]] = {
+  "subscriptions": {
+      "key": "user_id",
+      "date_column": "created_at",
+      "columns": ["user_id", "username", "first_name", "txid", "start_date", "end_date", "is_active", "reminder_sent_12h", "created_at"],
+  },
+  "transactions": {
+      "key": "txid",
+      "date_column": "verified_at",
+      "columns": ["txid", "user_id", "amount", "verified_at"],
+  },
+}
+
+
+def parse_export_date(value: str) -> date:
+  """Pārveido YYYY-MM-DD virkni par datumu"""
+  try:
+      return datetime.strptime(value, "%Y-%m-%d").date()
+  except ValueError:
+      raise ValueError(f"Nepareizs datuma formāts: {value!r}. Jābūt YYYY-MM-DD.")
+
+
+class SupabaseExporter:
+  """Straumē Supabase tabulas uz CSV vai NDJSON failu ar keyset lapošanu"""
+
+  def __init__(self, supabase: Client, page_size: int = EXPORT_PAGE_SIZE):
+      self.supabase = supabase
+      self.page_size = page_size
+
+  def build_filters(self, table: str, date_from: Optional[date] = None, date_to: Optional[date] = None, active_only: bool = False) -> List[Tuple[str, str, Any]]:
+      """Sagatavo filtrus kā (metode, kolonna, vērtība) sarakstu"""
+      if table not in EXPORT_TABLES:
+          raise ValueError(f"Nezināma tabula: {table!r}. Pieejamās: {', '.join(EXPORT_TABLES)}")
+
+      date_column = EXPORT_TABLES[table]["date_column"]
+      filters: List[Tuple[str, str, Any]] = []
+      if date_from:
+          filters.append(("gte", date_column, date_from.isoformat()))
+      if date_to:
+          # date_to ir ieskaitot, tāpēc filtrējam līdz nākamās dienas sākumam
+          filters.append(("lt", date_column, (date_to + timedelta(days=1)).isoformat()))
+      if active_only:
+          if table != "subscriptions":
+              raise ValueError("Filtrs 'active' ir pieejams tikai subscriptions tabulai.")
+          filters.append(("eq", "is_active", True))
+      return filters
+
+  def iter_pages(self, table: str, columns: List[str], key: str, filters: Optional[List[Tuple]] = None, after_key: Optional[Any] = None) -> Iterator[List[Dict[str, Any]]]:
+      """Atgriež rindas pa lapām, lapojot pēc unikālās atslēgas (bez OFFSET).
+
+      Filtri ir (metode, *argumenti) korteži, piem. ("eq", "is_active", True) vai ("or_", "..."). Beidz tikai
+      pie tukšas lapas, jo PostgREST max_rows var atgriezt mazāk rindu nekā pieprasīts, pat ja datu vēl ir.
+      """
+      last_key = after_key
+      while True:
+          query = self.supabase.table(table).select(",".join(columns))
+          for method, *args in filters or []:
+              query = getattr(query, method)(*args)
+          if last_key is not None:
+              query = query.gt(key, last_key)
+          response = query.order(key).limit(self.page_size).execute()
+
+          rows = response.data or []
+          logger.debug(f"Page from {table}: {len(rows)} rows after key {last_key!r}")
+          if not rows:
+              return
+          yield rows
+          last_key = rows[-1][key]
+
+  def iter_rows(self, table: str, columns: List[str], key: str, filters: Optional[List[Tuple]] = None) -> Iterator[Dict[str, Any]]:
+      """Atgriež rindas pa vienai (skat. iter_pages)"""
+      for rows in self.iter_pages(table, columns, key, filters):
+          yield from rows
+
+  def export(self, table: str, fmt: str, path: str, date_from: Optional[date] = None, date_to: Optional[date] = None, active_only: bool = False) -> int:
+      """Eksportē tabulu failā un atgriež eksportēto rindu skaitu. Ja ceļš beidzas ar .gz, fails tiek saspiests."""
+      if fmt not in EXPORT_FORMATS:
+          raise ValueError(f"Nezināms formāts: {fmt!r}. Pieejamie: {', '.join(EXPORT_FORMATS)}")
+
+      filters = self.build_filters(table, date_from, date_to, active_only)
+      spec = EXPORT_TABLES[table]
+      columns = spec["columns"]
+      opener = gzip.open if path.endswith(".gz") else open
+
+      count = 0
+      with opener(path, "wt", encoding="utf-8", newline="") as f:
+          if fmt == "csv":
+              writer = csv.DictWriter(f, fieldnames=columns, extrasaction="ignore")
+              writer.writeheader()
+          for row in self.iter_rows(table, columns, spec["key"], filters):
+              if fmt == "csv":
+                  writer.writerow(row)
+              else:
+                  f.write(json.dumps(row, ensure_ascii=False) + "\n")
+              count += 1
+
+      logger.info(f"Exported {count} rows from {table} to {path}")
+      return count
+
+  def export_to_tempfile(self, table: str, fmt: str, date_from: Optional[date] = None, date_to: Optional[date] = None, active_only: bool = False) -> Tuple[str, int]:
+      """Eksportē tabulu saspiestā pagaidu failā, atgriež (ceļš, rindu skaits)"""
+      stamp = datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S")
+      fd, path = tempfile.mkstemp(prefix=f"{table}_{stamp}_", suffix=f".{fmt}.gz")
+      os.close(fd)
+      try:
+          count = self.export(table, fmt, path, date_from, date_to, active_only)
+      except Exception:
+          os.remove(path)
+          raise
+      return path, count
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+  """Komandrindas eksports: python exporter.py <tabula> -o <fails>"""
+  parser = argparse.ArgumentParser(description="Eksportē subscriptions vai transactions tabulu uz CSV/NDJSON failu.")
+  parser.add_argument("table", choices=list(EXPORT_TABLES))
+  parser.add_argument("-o", "--output", required=True, help="Izvades fails (ja beidzas ar .gz, tiek saspiests)")
+  parser.add_argument("-f", "--format", choices=EXPORT_FORMATS, default="csv")
+  parser.add_argument("--from", dest="date_from", type=parse_export_date, help="Sākuma datums YYYY-MM-DD (ieskaitot)")
+  parser.add_argument("--to", dest="date_to", type=parse_export_date, help="Beigu datums YYYY-MM-DD (ieskaitot)")
+  parser.add_argument("--active", action="store_true", help="Tikai aktīvie abonementi")
+  parser.add_argument("--page-size", type=int, default=EXPORT_PAGE_SIZE)
+  args = parser.parse_args(argv)
+
+  load_dotenv()
+  supabase = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY"))
+  exporter = SupabaseExporter(supabase, page_size=args.page_size)
+  try:
+      count = exporter.export(args.table, args.format, args.output, args.date_from, args.date_to, args.active)
+  except ValueError as e:
+      parser.error(str(e))
+  print(f"✅ Eksportētas {count} rindas: {args.output}")
+  return 0
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+  sys.exit(main())
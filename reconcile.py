@@ -0,0 +1,355 @@
+import os
+import json
+import asyncio
+import logging
+
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Dict, Any, List
+from telegram import Bot
+from telegram.error import TelegramError, RetryAfter, BadRequest
+from supabase import Client
+from exporter import SupabaseExporter
+
+logger = logging.getLogger(__name__)
+
+RECONCILE_PAGE_SIZE = 200
+RECONCILE_CONCURRENCY = 5  # Vienlaicīgi get_chat_member pieprasījumi
+RECONCILE_RATE_LIMIT = 20  # Maksimālais Telegram API pieprasījumu skaits sekundē
+RECONCILE_RECENT_DAYS = 7  # Cik dienas pēc beigām vēl pārbaudām neaktīvos abonementus
+RECONCILE_TRANSACTION_DAYS = 30  # Cik dienas atpakaļ meklējam transakcijas bez abonementa
+RECONCILE_CHECKPOINT_FILE = os.getenv("RECONCILE_CHECKPOINT_FILE", "reconcile_checkpoint.json")
+RECONCILE_SAMPLE_SIZE = 20  # Cik user_id katrā kategorijā parādīt atskaitē
+
+# Atšķirību kategorijas un to apraksti admina atskaitei
+RECONCILE_CATEGORIES = {
+  "expired_in_group": "Beidzies abonements, bet joprojām grupā (izmesti)",
+  "stale_active": "Aktīvs datubāzē, bet beidzies un nav grupā (deaktivizēti)",
+  "banned_paid": "Derīgs abonements, bet bloķēts grupā (atbloķēti)",
+  "missing_paid": "Derīgs abonements, bet nav grupā (tikai atskaitei)",
+  "missing_subscription": "Apmaksāta transakcija bez abonementa (abonements izveidots)",
+  "failed": "Neizdevās izmest vai atbloķēt (skaties logus)",
+  "errors": "Neizdevās pārbaudīt",
+}
+
+IN_GROUP_STATUSES = ("member", "restricted")
+SKIP_STATUSES = ("administrator", "creator")
+
+
+class RateLimiter:
+  """Ierobežo pieprasījumu biežumu līdz rate pieprasījumiem sekundē"""
+
+  def __init__(self, rate: float):
+      self.interval = 1.0 / rate
+      self.lock = asyncio.Lock()
+      self.next_time = 0.0
+
+  async def wait(self):
+      async with self.lock:
+          loop = asyncio.get_running_loop()
+          now = loop.time()
+          if self.next_time > now:
+              await asyncio.sleep(self.next_time - now)
+          self.next_time = max(now, self.next_time) + self.interval
+
+
+class MembershipReconciler:
+  """Salīdzina subscriptions.is_active ar faktisko dalību grupā un izlabo atšķirības"""
+
+  def __init__(self, bot: Bot, supabase: Client, group_id: int, subscription_days: int, rollups=None, checkpoint_path: str = RECONCILE_CHECKPOINT_FILE):
+      self.bot = bot
+      self.supabase = supabase
+      self.group_id = group_id
+      self.subscription_days = subscription_days
+      self.rollups = rollups
+      self.checkpoint_path = checkpoint_path
+      self.semaphore = asyncio.Semaphore(RECONCILE_CONCURRENCY)
+      self.limiter = RateLimiter(RECONCILE_RATE_LIMIT)
+      self.exporter = SupabaseExporter(supabase, page_size=RECONCILE_PAGE_SIZE)
+
+  def load_checkpoint(self) -> Optional[Dict[str, Any]]:
+      """Nolasa iepriekšējā nepabeigtā skrējiena stāvokli"""
+      if not os.path.exists(self.checkpoint_path):
+          return None
+      try:
+          with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+              return json.load(f)
+      except (OSError, ValueError) as e:
+          logger.error(f"Error reading reconcile checkpoint {self.checkpoint_path}: {e}")
+          return None
+
+  def save_checkpoint(self, state: Dict[str, Any]):
+      """Saglabā stāvokli atomāri (caur pagaidu failu)"""
+      tmp_path = self.checkpoint_path + ".tmp"
+      with open(tmp_path, "w", encoding="utf-8") as f:
+          json.dump(state, f)
+      os.replace(tmp_path, self.checkpoint_path)
+
+  def clear_checkpoint(self):
+      if os.path.exists(self.checkpoint_path):
+          os.remove(self.checkpoint_path)
+
+  async def _call(self, method, **kwargs):
+      """Izsauc Telegram API ar concurrency un ātruma ierobežojumu, atkārto pēc RetryAfter"""
+      async with self.semaphore:
+          for attempt in range(3):
+              await self.limiter.wait()
+              try:
+                  return await method(**kwargs)
+              except RetryAfter as e:
+                  delay = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+                  logger.warning(f"Telegram flood control, sleeping {delay}s")
+                  await asyncio.sleep(delay)
+          raise TelegramError("Pārāk daudz RetryAfter atkārtojumu")
+
+  async def _member_status(self, user_id: str) -> Optional[str]:
+      """Atgriež lietotāja statusu grupā vai None, ja neizdevās pārbaudīt"""
+      try:
+          member = await self._call(self.bot.get_chat_member, chat_id=self.group_id, user_id=int(user_id))
+      except BadRequest as e:
+          # Telegram atbild ar "user not found", ja lietotājs grupā nekad nav bijis
+          if "not found" in str(e).lower():
+              return "left"
+          logger.error(f"Error checking membership for {user_id}: {e}")
+          return None
+      except TelegramError as e:
+          logger.error(f"Error checking membership for {user_id}: {e}")
+          return None
+      if member.status == "restricted" and not getattr(member, "is_member", True):
+          return "left"
+      return member.status
+
+  def _classify(self, row: Dict[str, Any], status: Optional[str], now: datetime) -> Optional[str]:
+      """Nosaka atšķirības kategoriju vienam abonementam"""
+      if status is None:
+          return "errors"
+      if status in SKIP_STATUSES:
+          return None
+      paid = row["is_active"] and datetime.fromisoformat(row["end_date"]) > now
+      in_group = status in IN_GROUP_STATUSES
+      if not paid and in_group:
+          return "expired_in_group"
+      if row["is_active"] and not paid:
+          return "stale_active"
+      if paid and status == "kicked":
+          return "banned_paid"
+      if paid and status == "left":
+          return "missing_paid"
+      return None
+
+  async def _kick(self, user_id: str) -> bool:
+      try:
+          await self._call(self.bot.ban_chat_member, chat_id=self.group_id, user_id=int(user_id))
+          await self._call(self.bot.unban_chat_member, chat_id=self.group_id, user_id=int(user_id))
+          return True
+      except TelegramError as e:
+          logger.error(f"Error kicking {user_id} during reconcile: {e}")
+          return False
+
+  async def _unban(self, user_id: str) -> bool:
+      try:
+          await self._call(self.bot.unban_chat_member, chat_id=self.group_id, user_id=int(user_id), only_if_banned=True)
+          return True
+      except TelegramError as e:
+          logger.error(f"Error unbanning {user_id} during reconcile: {e}")
+          return False
+
+  def _still_expired(self, user_ids: List[str], now: datetime) -> Dict[str, bool]:
+      """Atkārtoti nolasa abonementus un atgriež {user_id: is_active} tiem, kas joprojām nav derīgi"""
+      response = self.supabase.table("subscriptions").select("user_id, is_active, end_date").in_("user_id", user_ids).execute()
+      return {
+          row["user_id"]: row["is_active"] for row in response.data or []
+          if not (row["is_active"] and datetime.fromisoformat(row["end_date"]) > now)
+      }
+
+  def _deactivate(self, user_ids: List[str], now: datetime) -> List[str]:
+      """Deaktivizē abonementus vienā pieprasījumā, ja tie joprojām ir beigušies, atgriež mainītos user_id"""
+      response = (
+          self.supabase.table("subscriptions").update({"is_active": False})
+          .in_("user_id", user_ids).eq("is_active", True).lt("end_date", now.isoformat())
+          .execute()
+      )
+      return [row["user_id"] for row in response.data or []]
+
+  async def _fix_page(self, categories: Dict[str, str]) -> int:
+      """Izlabo vienas lapas atšķirības, atgriež deaktivizēto abonementu skaitu.
+
+      Abonementi, kas pārbaudes laikā atjaunoti, tiek izņemti no categories, bet neizdevušās
+      izmešanas un atbloķēšanas tiek pārceltas uz "failed", lai atskaite atbilstu paveiktajam.
+      """
+      to_kick = [user_id for user_id, category in categories.items() if category == "expired_in_group"]
+      to_unban = [user_id for user_id, category in categories.items() if category == "banned_paid"]
+      stale = [user_id for user_id, category in categories.items() if category == "stale_active"]
+
+      unbanned = await asyncio.gather(*(self._unban(user_id) for user_id in to_unban))
+      for user_id, ok in zip(to_unban, unbanned):
+          if not ok:
+              categories[user_id] = "failed"
+      if not to_kick and not stale:
+          return 0
+
+      # Statusa pārbaude var ilgt vairākas sekundes, tāpēc pirms izmešanas pārliecināmies,
+      # ka lietotājs tikmēr nav atjaunojis abonementu
+      now = datetime.now(timezone.utc)
+      expired = await asyncio.to_thread(self._still_expired, to_kick + stale, now)
+      for user_id in to_kick + stale:
+          if user_id not in expired:
+              del categories[user_id]
+      to_kick = [user_id for user_id in to_kick if user_id in expired]
+      kicked = await asyncio.gather(*(self._kick(user_id) for user_id in to_kick))
+      for user_id, ok in zip(to_kick, kicked):
+          if not ok:
+              categories[user_id] = "failed"
+
+      to_deactivate = [user_id for user_id, ok in zip(to_kick, kicked) if ok and expired[user_id]]
+      stale = [user_id for user_id in stale if user_id in expired]
+      to_deactivate += stale
+      if not to_deactivate:
+          return 0
+      deactivated = await asyncio.to_thread(self._deactivate, to_deactivate, now)
+      # Ja abonements pa šo laiku mainījies, to neatzīmējam kā deaktivizētu
+      for user_id in set(stale) - set(deactivated):
+          del categories[user_id]
+      return len(deactivated)
+
+  def _record(self, state: Dict[str, Any], user_id: str, category: str):
+      state["counts"][category] += 1
+      if len(state["samples"][category]) < RECONCILE_SAMPLE_SIZE:
+          state["samples"][category].append(user_id)
+
+  async def _reconcile_subscriptions(self, state: Dict[str, Any]):
+      """Pārbauda aktīvos un nesen beigušos abonementus pret dalību grupā"""
+      filters = [("or_", f"is_active.eq.true,end_date.gte.{state['cutoff']}")]
+      pages = self.exporter.iter_pages("subscriptions", ["user_id", "is_active", "end_date"], "user_id", filters, state["last_key"])
+      while True:
+          rows = await asyncio.to_thread(next, pages, None)
+          if rows is None:
+              return
+
+          now = datetime.now(timezone.utc)
+          statuses = await asyncio.gather(*(self._member_status(row["user_id"]) for row in rows))
+          categories = {}
+          for row, status in zip(rows, statuses):
+              category = self._classify(row, status, now)
+              if category:
+                  categories[row["user_id"]] = category
+
+          deactivated = await self._fix_page(categories)
+          for user_id, category in categories.items():
+              self._record(state, user_id, category)
+          if deactivated and self.rollups:
+              try:
+                  await asyncio.to_thread(self.rollups.record_churn, now.date(), deactivated)
+              except Exception as e:
+                  logger.error(f"Error recording reconcile churn: {e}")
+
+          state["checked"] += len(rows)
+          state["deactivated"] += deactivated
+          state["last_key"] = rows[-1]["user_id"]
+          self.save_checkpoint(state)
+          logger.debug(f"Reconcile page done: {len(rows)} rows, last user_id {state['last_key']!r}")
+
+  def _create_missing_subscriptions(self, user_ids: List[str], cutoff: str) -> List[str]:
+      """Izveido abonementus lietotājiem ar apmaksātu transakciju, bet bez subscriptions rindas.
+
+      Abonements sākas ar lietotāja jaunākās transakcijas verified_at. Esošas rindas netiek pārrakstītas,
+      tāpēc atkārtota palaišana tos pašus lietotājus neskaita vēlreiz. Atgriež izveidotos user_id.
+      """
+      response = self.supabase.table("subscriptions").select("user_id").in_("user_id", user_ids).execute()
+      subscribed = {row["user_id"] for row in response.data or []}
+      missing = [user_id for user_id in user_ids if user_id not in subscribed]
+      if not missing:
+          return []
+
+      response = (
+          self.supabase.table("transactions").select("txid, user_id, verified_at")
+          .in_("user_id", missing).gte("verified_at", cutoff).execute()
+      )
+      latest: Dict[str, Dict[str, Any]] = {}
+      for tx in response.data or []:
+          if tx["user_id"] not in latest or tx["verified_at"] > latest[tx["user_id"]]["verified_at"]:
+              latest[tx["user_id"]] = tx
+
+      now = datetime.now(timezone.utc)
+      rows = []
+      for user_id, tx in latest.items():
+          start_date = datetime.fromisoformat(tx["verified_at"])
+          end_date = start_date + timedelta(days=self.subscription_days)
+          rows.append({
+              "user_id": user_id,
+              "username": "",
+              "first_name": "",
+              "txid": tx["txid"],
+              "start_date": start_date.isoformat(),
+              "end_date": end_date.isoformat(),
+              "is_active": end_date > now,
+              "reminder_sent_12h": False,
+              "created_at": now.isoformat(),
+          })
+      if not rows:
+          return []
+      # ignore_duplicates: ja save_subscription pa to laiku izveidoja rindu, to nepārrakstām
+      response = self.supabase.table("subscriptions").upsert(rows, ignore_duplicates=True).execute()
+      return [row["user_id"] for row in response.data or []]
+
+  async def _reconcile_transactions(self, state: Dict[str, Any]):
+      """Atjauno abonementus nesenām transakcijām bez subscriptions rindas (piem., neizdevās save_subscription)"""
+      filters = [("gte", "verified_at", state["tx_cutoff"])]
+      pages = self.exporter.iter_pages("transactions", ["txid", "user_id"], "txid", filters, state["tx_last_key"])
+      while True:
+          rows = await asyncio.to_thread(next, pages, None)
+          if rows is None:
+              return
+
+          user_ids = list({row["user_id"] for row in rows})
+          created = await asyncio.to_thread(self._create_missing_subscriptions, user_ids, state["tx_cutoff"])
+          for user_id in created:
+              self._record(state, user_id, "missing_subscription")
+
+          state["tx_last_key"] = rows[-1]["txid"]
+          self.save_checkpoint(state)
+          logger.debug(f"Reconcile transactions page done: {len(rows)} rows, last txid {state['tx_last_key']!r}")
+
+  async def run(self) -> Dict[str, Any]:
+      """Palaiž (vai turpina no checkpoint) salīdzināšanu un atgriež atskaites stāvokli"""
+      state = self.load_checkpoint()
+      if state:
+          logger.info(f"Resuming reconcile from checkpoint: phase {state['phase']!r}")
+      else:
+          started_at = datetime.now(timezone.utc)
+          state = {
+              "started_at": started_at.isoformat(),
+              "cutoff": (started_at - timedelta(days=RECONCILE_RECENT_DAYS)).date().isoformat(),
+              "tx_cutoff": (started_at - timedelta(days=RECONCILE_TRANSACTION_DAYS)).date().isoformat(),
+              "phase": "transactions",
+              "last_key": None,
+              "tx_last_key": None,
+              "checked": 0,
+              "deactivated": 0,
+              "counts": {category: 0 for category in RECONCILE_CATEGORIES},
+              "samples": {category: [] for category in RECONCILE_CATEGORIES},
+          }
+
+      # Vispirms izveido trūkstošos abonementus, lai tie tiktu iekļauti parastajā dalības pārbaudē
+      if state["phase"] == "transactions":
+          await self._reconcile_transactions(state)
+          state["phase"] = "subscriptions"
+          self.save_checkpoint(state)
+      await self._reconcile_subscriptions(state)
+
+      self.clear_checkpoint()
+      logger.info(f"Reconcile complete: checked {state['checked']}, counts {state['counts']}")
+      return state
+
+  @staticmethod
+  def format_report(state: Dict[str, Any]) -> str:
+      """Sagatavo atskaiti adminam"""
+      lines = ["🔍 Grupas dalības pārbaude pabeigta", f"Pārbaudīti abonementi: {state['checked']}"]
+      for category, description in RECONCILE_CATEGORIES.items():
+          count = state["counts"][category]
+          if count:
+              samples = ", ".join(state["samples"][category])
+              more = "..." if count > len(state["samples"][category]) else ""
+              lines.append(f"• {description}: {count}\n  {samples}{more}")
+      if not any(state["counts"].values()):
+          lines.append("✅ Atšķirības nav atrastas.")
+      return "\n".join(lines)
@@ -0,0 +1,141 @@
+import os
+import sys
+import logging
+import argparse
+
+from datetime import datetime, date, timezone
+from typing import Optional, Dict, Any, List
+from dotenv import load_dotenv
+from supabase import create_client, Client
+from exporter import SupabaseExporter, parse_export_date
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_TABLE = "daily_revenue"
+ROLLUP_COUNTERS = ("transactions_count", "revenue", "new_subscribers", "renewing_subscribers", "churned")
+# Cik dienas tiek saglabātas vienā upsert pieprasījumā backfill laikā
+ROLLUP_UPSERT_BATCH = 500
+
+
+class RevenueRollups:
+  """Uztur dienas kopsummas daily_revenue tabulā, lai atskaites nebūtu jāskaita no visām transakcijām"""
+
+  def __init__(self, supabase: Client):
+      self.supabase = supabase
+
+  def _add_to_day(self, day: date, deltas: Dict[str, Any]):
+      """Atomāri pieskaita vērtības vienas dienas rindai ar add_daily_revenue funkciju (sql/daily_revenue.sql)"""
+      params = {"p_day": day.isoformat()}
+      for counter in ROLLUP_COUNTERS:
+          params[f"p_{counter}"] = deltas.get(counter, 0)
+      self.supabase.rpc("add_daily_revenue", params).execute()
+      logger.debug(f"Rollup for {day} incremented by {deltas}")
+
+  def is_renewal(self, user_id: int, txid: str) -> bool:
+      """Vai lietotājam ir cita (agrāka) transakcija – tas pats noteikums kā backfill"""
+      response = self.supabase.table("transactions").select("txid").eq("user_id", str(user_id)).neq("txid", txid).limit(1).execute()
+      return bool(response.data)
+
+  def record_transaction(self, verified_at: datetime, amount: float, is_renewal: bool):
+      """Pieskaita jaunu transakciju dienas kopsummai"""
+      self._add_to_day(verified_at.date(), {
+          "transactions_count": 1,
+          "revenue": amount,
+          "renewing_subscribers" if is_renewal else "new_subscribers": 1,
+      })
+
+  def record_churn(self, day: date, count: int):
+      """Pieskaita dienā noņemtos (beigušos) abonentus"""
+      if count:
+          self._add_to_day(day, {"churned": count})
+
+  def report(self, date_from: date, date_to: date) -> Dict[str, Any]:
+      """Saskaita kopsummas periodā no date_from līdz date_to (ieskaitot) Postgres pusē"""
+      response = self.supabase.rpc("daily_revenue_report", {"p_from": date_from.isoformat(), "p_to": date_to.isoformat()}).execute()
+      row = response.data[0] if response.data else {}
+      totals: Dict[str, Any] = {counter: row.get(counter) or 0 for counter in ROLLUP_COUNTERS}
+      totals["days"] = row.get("days") or 0
+      return totals
+
+  def backfill(self) -> int:
+      """Pārrēķina transakciju kopsummas visām pagājušajām dienām, atgriež dienu skaitu.
+
+      Jauns abonents ir tas, kura pirmā transakcija notika attiecīgajā dienā. Šodiena netiek aiztikta,
+      jo to vienlaikus atjauno save_transaction. Churn netiek pārrēķināts: tas tiek skaitīts tikai dienā,
+      kad abonementu deaktivizē check_expired_subscriptions vai dalības pārbaude, un šo vēsturi nevar atjaunot.
+      """
+      exporter = SupabaseExporter(self.supabase)
+      cutoff = datetime.now(timezone.utc).date()
+      days: Dict[str, Dict[str, Any]] = {}
+      first_day: Dict[str, str] = {}
+      tx_counters = ("transactions_count", "revenue", "new_subscribers", "renewing_subscribers")
+
+      def day_row(day: str) -> Dict[str, Any]:
+          if day not in days:
+              days[day] = {"day": day, **{counter: 0 for counter in tx_counters}}
+          return days[day]
+
+      filters = [("lt", "verified_at", cutoff.isoformat())]
+      for tx in exporter.iter_rows("transactions", ["txid", "user_id", "amount", "verified_at"], "txid", filters):
+          if not tx.get("verified_at"):
+              continue
+          day = datetime.fromisoformat(tx["verified_at"]).astimezone(timezone.utc).date().isoformat()
+          row = day_row(day)
+          row["transactions_count"] += 1
+          row["revenue"] += tx.get("amount") or 0
+          user_id = tx["user_id"]
+          if user_id not in first_day or day < first_day[user_id]:
+              first_day[user_id] = day
+
+      for day in first_day.values():
+          day_row(day)["new_subscribers"] += 1
+      for row in days.values():
+          row["renewing_subscribers"] = row["transactions_count"] - row["new_subscribers"]
+
+      # Upsert ar tikai transakciju kolonnām atstāj esošo churned vērtību nemainītu
+      now = datetime.now(timezone.utc).isoformat()
+      rows: List[Dict[str, Any]] = sorted(days.values(), key=lambda r: r["day"])
+      for row in rows:
+          row["updated_at"] = now
+      for i in range(0, len(rows), ROLLUP_UPSERT_BATCH):
+          self.supabase.table(ROLLUP_TABLE).upsert(rows[i:i + ROLLUP_UPSERT_BATCH]).execute()
+
+      # Dienām, kurām vairs nav transakciju, nodzēšam transakciju skaitītājus (churned paliek)
+      stale_days = [
+          row["day"] for row in exporter.iter_rows(ROLLUP_TABLE, ["day"], "day", [("lt", "day", cutoff.isoformat())])
+          if row["day"] not in days
+      ]
+      for i in range(0, len(stale_days), ROLLUP_UPSERT_BATCH):
+          self.supabase.table(ROLLUP_TABLE).update({
+              **{counter: 0 for counter in tx_counters},
+              "updated_at": now,
+          }).in_("day", stale_days[i:i + ROLLUP_UPSERT_BATCH]).execute()
+
+      logger.info(f"Rollup backfill complete: {len(rows)} days from {len(first_day)} users, {len(stale_days)} stale days reset")
+      return len(rows)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+  """Komandrinda: python rollups.py backfill | report <no> <līdz>"""
+  parser = argparse.ArgumentParser(description="Dienas ieņēmumu kopsummas.")
+  subparsers = parser.add_subparsers(dest="command", required=True)
+  subparsers.add_parser("backfill", help="Pārrēķināt visas dienas no transakciju vēstures")
+  report_parser = subparsers.add_parser("report", help="Ieņēmumi periodā")
+  report_parser.add_argument("date_from", type=parse_export_date)
+  report_parser.add_argument("date_to", type=parse_export_date)
+  args = parser.parse_args(argv)
+
+  load_dotenv()
+  rollups = RevenueRollups(create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY")))
+  if args.command == "backfill":
+      print(f"✅ Pārrēķinātas {rollups.backfill()} dienas")
+  else:
+      totals = rollups.report(args.date_from, args.date_to)
+      for key, value in totals.items():
+          print(f"{key}: {value}")
+  return 0
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+  sys.exit(main())
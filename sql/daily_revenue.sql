@@ -0,0 +1,57 @@
+-- Dienas ieņēmumu kopsummas (rollups.py). Izpildi vienreiz Supabase SQL redaktorā.
+
+create table if not exists daily_revenue (
+  day date primary key,
+  transactions_count integer not null default 0,
+  revenue numeric not null default 0,
+  new_subscribers integer not null default 0,
+  renewing_subscribers integer not null default 0,
+  churned integer not null default 0,
+  updated_at timestamptz not null default now()
+);
+
+-- Atomāri pieskaita vērtības dienas rindai (izveido rindu, ja tās vēl nav)
+create or replace function add_daily_revenue(
+  p_day date,
+  p_transactions_count integer default 0,
+  p_revenue numeric default 0,
+  p_new_subscribers integer default 0,
+  p_renewing_subscribers integer default 0,
+  p_churned integer default 0
+) returns void
+language sql
+as $$
+  insert into daily_revenue as d (day, transactions_count, revenue, new_subscribers, renewing_subscribers, churned, updated_at)
+  values (p_day, p_transactions_count, p_revenue, p_new_subscribers, p_renewing_subscribers, p_churned, now())
+  on conflict (day) do update set
+    transactions_count = d.transactions_count + excluded.transactions_count,
+    revenue = d.revenue + excluded.revenue,
+    new_subscribers = d.new_subscribers + excluded.new_subscribers,
+    renewing_subscribers = d.renewing_subscribers + excluded.renewing_subscribers,
+    churned = d.churned + excluded.churned,
+    updated_at = now();
+$$;
+
+-- Kopsummas periodā (ieskaitot abus datumus), saskaitītas serverī
+create or replace function daily_revenue_report(p_from date, p_to date)
+returns table (
+  days bigint,
+  transactions_count bigint,
+  revenue numeric,
+  new_subscribers bigint,
+  renewing_subscribers bigint,
+  churned bigint
+)
+language sql
+stable
+as $$
+  select
+    count(*),
+    coalesce(sum(transactions_count), 0),
+    coalesce(sum(revenue), 0),
+    coalesce(sum(new_subscribers), 0),
+    coalesce(sum(renewing_subscribers), 0),
+    coalesce(sum(churned), 0)
+  from daily_revenue
+  where day between p_from and p_to;
+$$;